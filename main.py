@@ -1,31 +1,87 @@
 import os
+import re
+import logging
+import time
+import asyncio
+import multiprocessing
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import List, Optional, Dict, Any
 
 from fastapi import FastAPI, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field, EmailStr
-from jose import jwt, JWTError
+import jwt
 from passlib.context import CryptContext
+from cachetools import TLRUCache, TTLCache
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
 
-from database import db, create_document, get_documents
+from database import db, create_document, create_documents, aggregate_documents
 from schemas import User as UserSchema, Product as ProductSchema, Order as OrderSchema
 
+logger = logging.getLogger(__name__)
+
 # Environment
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret-change-me")
 JWT_ALG = "HS256"
+# HMAC key bytes, encoded once rather than on every sign/verify
+_JWT_KEY = JWT_SECRET.encode()
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
+# Comma-separated list of frontend origins; unset keeps the permissive "*"
+ALLOWED_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()] or ["*"]
+
+# Configure Stripe once; a shared RequestsClient keeps connections alive
+# across payment intents instead of a fresh TLS handshake per request.
+# The SDK is optional: if it isn't installed the payment route reports a
+# Stripe error instead of the whole app failing to import.
+stripe = None
+if STRIPE_SECRET_KEY:
+    try:
+        import stripe
+    except ImportError:
+        stripe = None
+    else:
+        stripe.api_key = STRIPE_SECRET_KEY
+        stripe.max_network_retries = 2
+        # stripe>=8 exports RequestsClient; older SDKs only have http_client
+        requests_client = getattr(stripe, "RequestsClient", None) or stripe.http_client.RequestsClient
+        stripe.default_http_client = requests_client()
+
+# JSON schemas are fixed for the life of the process; build them once
+_SCHEMA_CACHE: Dict[str, Any] = {
+    "user": UserSchema.model_json_schema(),
+    "product": ProductSchema.model_json_schema(),
+    "order": OrderSchema.model_json_schema(),
+}
+
+# bcrypt work factor. Each step doubles hashing time (and brute-force cost):
+# 12 is a sensible production floor, 10 keeps local dev and tests snappy.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=BCRYPT_ROUNDS, deprecated="auto")
+
+# bcrypt is CPU-bound; run it out of process so auth bursts don't stall the
+# event loop. Beyond BCRYPT_MAX_INFLIGHT queued jobs we shed load with a 503.
+# Workers come from a forkserver: forking this process once Motor's threads
+# are running could deadlock the child.
+BCRYPT_POOL = ProcessPoolExecutor(
+    max_workers=2 * (os.cpu_count() or 1),
+    mp_context=multiprocessing.get_context("forkserver"),
+)
+BCRYPT_MAX_INFLIGHT = 500
+_bcrypt_slots = asyncio.Semaphore(BCRYPT_MAX_INFLIGHT)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-app = FastAPI(title="E-commerce API", version="1.0.0")
+app = FastAPI(title="E-commerce API", version="1.0.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
 )
 
 # --------------------- Utility ---------------------
@@ -38,11 +94,51 @@ def verify_password(password: str, password_hash: str) -> bool:
     return pwd_context.verify(password, password_hash)
 
 
+async def _run_bcrypt(fn, *args):
+    if _bcrypt_slots.locked():
+        raise HTTPException(status_code=503, detail="Server busy, retry shortly", headers={"Retry-After": "1"})
+    async with _bcrypt_slots:
+        return await asyncio.get_running_loop().run_in_executor(BCRYPT_POOL, fn, *args)
+
+
+async def hash_password_async(password: str) -> str:
+    return await _run_bcrypt(hash_password, password)
+
+
+async def verify_password_async(password: str, password_hash: str) -> bool:
+    return await _run_bcrypt(verify_password, password, password_hash)
+
+
 def create_token(data: dict, expires_minutes: int = 60 * 24) -> str:
-    to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(minutes=expires_minutes)
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALG)
+    return jwt.encode({**data, "exp": expire}, _JWT_KEY, algorithm=JWT_ALG)
+
+
+# Decoded JWT payloads keyed by token digest. Entries live for at most 30s and
+# never past the token's own "exp", so an expired token always re-hits
+# jwt.decode and gets rejected there. Invalid tokens raise before insertion.
+# cachetools caches aren't thread-safe, so only touch this from the event loop
+# (the auth dependencies below are async for that reason).
+JWT_CACHE_TTL = 30
+
+
+def _jwt_ttu(_key: str, payload: dict, now: float) -> float:
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        return min(now + JWT_CACHE_TTL, exp)
+    return now + JWT_CACHE_TTL
+
+
+_JWT_CACHE: TLRUCache = TLRUCache(maxsize=10000, ttu=_jwt_ttu, timer=time.time)
+
+
+def _decode_cached(token: str) -> dict:
+    key = hashlib.sha256(token.encode()).hexdigest()[:16]
+    payload = _JWT_CACHE.get(key)
+    if payload is None:
+        payload = jwt.decode(token, _JWT_KEY, algorithms=[JWT_ALG], options={"verify_aud": False})
+        _JWT_CACHE[key] = payload
+    return payload
 
 
 class AuthUser(BaseModel):
@@ -52,7 +148,7 @@ class AuthUser(BaseModel):
     role: str = "customer"
 
 
-def get_current_user(authorization: Optional[str] = Header(None)) -> Optional[AuthUser]:
+async def get_current_user(authorization: Optional[str] = Header(None)) -> Optional[AuthUser]:
     if not authorization:
         raise HTTPException(status_code=401, detail="Missing Authorization header")
     try:
@@ -62,25 +158,25 @@ def get_current_user(authorization: Optional[str] = Header(None)) -> Optional[Au
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid Authorization header")
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
+        payload = _decode_cached(token)
         return AuthUser(**{
             "id": payload.get("id"),
             "email": payload.get("email"),
             "name": payload.get("name"),
             "role": payload.get("role", "customer"),
         })
-    except JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
 
 
-def get_optional_user(authorization: Optional[str] = Header(None)) -> Optional[AuthUser]:
+async def get_optional_user(authorization: Optional[str] = Header(None)) -> Optional[AuthUser]:
     if not authorization or authorization.strip().lower() == "bearer guest-token":
         return None
     try:
         scheme, token = authorization.split()
         if scheme.lower() != "bearer":
             return None
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
+        payload = _decode_cached(token)
         return AuthUser(**{
             "id": payload.get("id"),
             "email": payload.get("email"),
@@ -120,6 +216,171 @@ class PaymentIntentRequest(BaseModel):
     currency: str = "usd"
 
 
+# --------------------- Startup ---------------------
+
+# Demo catalog inserted when the product collection is empty
+SAMPLE_PRODUCTS = [
+    {
+        "title": "T-shirt Bio Confort",
+        "description": "Coton bio ultra doux, coupe moderne",
+        "price": 24.9,
+        "category": "Vêtements",
+        "images": ["https://images.unsplash.com/photo-1520975682031-a6c2b9d8b5f4?w=1200&q=80"],
+        "stock": 120,
+        "rating": 4.6,
+    },
+    {
+        "title": "Casque Sans Fil Pro",
+        "description": "Réduction de bruit active, 30h d'autonomie",
+        "price": 129.0,
+        "category": "Electronique",
+        "images": ["https://images.unsplash.com/photo-1518443206315-4e1dff4a1f0f?w=1200&q=80"],
+        "stock": 42,
+        "rating": 4.7,
+    },
+    {
+        "title": "Gourde Isotherme 1L",
+        "description": "Inox double paroi, garde au frais 24h",
+        "price": 19.9,
+        "category": "Sport",
+        "images": ["https://images.unsplash.com/photo-1563371351-e53ebb744a1f?w=1200&q=80"],
+        "stock": 300,
+        "rating": 4.5,
+    },
+]
+
+
+# Set on startup once we know the product collection has a text index
+# (title + description). Without it, search falls back to an anchored,
+# index-friendly title prefix regex.
+_product_text_index = False
+
+
+# (collection, keys, options). A collection can only hold one text index; if
+# a different one already exists, creating ours fails and the existing one is
+# used for search.
+INDEXES = [
+    ("user", "email", {"unique": True}),
+    ("product", [("category", 1)], {}),
+    ("product", [("title", "text"), ("description", "text")], {}),
+    ("order", "user_id", {}),
+]
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    global _product_text_index
+    if db is None:
+        return
+    # create_index is a no-op when the index already exists. Each one is tried
+    # on its own so a single failure (e.g. duplicate emails blocking the
+    # unique index) doesn't leave the rest uncreated.
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except PyMongoError as e:
+            logger.warning("Could not create index %s on %s: %s", keys, collection, e)
+    try:
+        indexes = await db["product"].index_information()
+    except PyMongoError as e:
+        # Boot anyway; search falls back to the title prefix regex and /test
+        # reports the database error
+        logger.warning("Could not read product indexes: %s", e)
+        return
+    _product_text_index = any(
+        field_type == "text"
+        for info in indexes.values()
+        for _, field_type in info.get("key", [])
+    )
+
+
+# Backstop for create_order's checks: Mongo itself rejects orders with no
+# items or a negative total, whichever code path writes them.
+ORDER_VALIDATOR: Dict[str, Any] = {
+    "$jsonSchema": {
+        "bsonType": "object",
+        "required": ["user_id", "items", "total"],
+        "properties": {
+            "items": {"bsonType": "array", "minItems": 1},
+            "total": {"bsonType": "number", "minimum": 0},
+        },
+    }
+}
+
+
+@app.on_event("startup")
+async def ensure_order_validator():
+    if db is None:
+        return
+    try:
+        if "order" in await db.list_collection_names(filter={"name": "order"}):
+            await db.command("collMod", "order", validator=ORDER_VALIDATOR)
+        else:
+            await db.create_collection("order", validator=ORDER_VALIDATOR)
+    except OperationFailure as e:
+        # e.g. missing collMod privileges or a rejected validator; the
+        # route-level check still applies
+        logger.warning("Order validator not installed: %s", e)
+    except PyMongoError as e:
+        # Database unreachable; like the other startup hooks, boot anyway
+        logger.warning("Order validator not installed, database error: %s", e)
+
+
+@app.on_event("startup")
+async def seed_products():
+    if db is None:
+        return
+    try:
+        # estimated_document_count reads collection metadata instead of scanning
+        if await db["product"].estimated_document_count() > 0:
+            return
+        await create_documents("product", SAMPLE_PRODUCTS)
+    except PyMongoError as e:
+        # Demo data is optional; never let it keep the API from booting
+        logger.warning("Could not seed sample products: %s", e)
+
+
+@app.on_event("shutdown")
+def shutdown_bcrypt_pool():
+    # Don't leave worker processes behind on shutdown or --reload
+    BCRYPT_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+# --------------------- Projections ---------------------
+
+# List endpoints return "cards": just enough to render a tile, not the full doc.
+# These are aggregation $project stages that also expose _id as a string "id",
+# so documents come back from Mongo already shaped for the client.
+PRODUCT_CARD_PROJECTION: Dict[str, Any] = {
+    "_id": 0,
+    "id": {"$toString": "$_id"},
+    "title": 1,
+    "price": 1,
+    "category": 1,
+    "images": {"$slice": ["$images", 1]},
+    "rating": 1,
+}
+
+ORDER_CARD_PROJECTION: Dict[str, Any] = {
+    "_id": 0,
+    "id": {"$toString": "$_id"},
+    "items": {"$slice": ["$items", 3]},
+    "total": 1,
+    "status": 1,
+    "created_at": 1,
+}
+
+
+# Only what login reads to verify the password and mint a token
+LOGIN_PROJECTION: Dict[str, Any] = {
+    "_id": 1,
+    "password_hash": 1,
+    "name": 1,
+    "email": 1,
+    "role": 1,
+}
+
+
 # --------------------- Routes ---------------------
 
 @app.get("/")
@@ -130,39 +391,37 @@ def root():
 @app.get("/schema")
 def get_schema():
     # Minimal schema surface for viewer
-    from schemas import User, Product, Order
-    return {
-        "user": User.model_json_schema(),
-        "product": Product.model_json_schema(),
-        "order": Order.model_json_schema(),
-    }
+    return _SCHEMA_CACHE
 
 
 # Auth
 @app.post("/api/auth/register")
-def register(req: RegisterRequest):
-    existing = db["user"].find_one({"email": req.email}) if db else None
-    if existing:
-        raise HTTPException(status_code=400, detail="Email already registered")
+async def register(req: RegisterRequest):
     user_doc = UserSchema(
         name=req.name,
         email=req.email,
-        password_hash=hash_password(req.password),
+        password_hash=await hash_password_async(req.password),
         address=None,
         role="customer",
         is_active=True,
     )
-    user_id = create_document("user", user_doc)
+    # The unique email index makes the insert itself the existence check: one
+    # round trip and no race between concurrent signups. The trade-off is that
+    # a duplicate email is only detected after its password has been hashed.
+    try:
+        user_id = await create_document("user", user_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     token = create_token({"id": user_id, "email": req.email, "name": req.name, "role": "customer"})
     return {"token": token, "user": {"id": user_id, "email": req.email, "name": req.name, "role": "customer"}}
 
 
 @app.post("/api/auth/login")
-def login(req: LoginRequest):
-    user = db["user"].find_one({"email": req.email}) if db else None
+async def login(req: LoginRequest):
+    user = await db["user"].find_one({"email": req.email}, LOGIN_PROJECTION) if db is not None else None
     if not user:
         raise HTTPException(status_code=400, detail="Invalid credentials")
-    if not verify_password(req.password, user.get("password_hash", "")):
+    if not await verify_password_async(req.password, user.get("password_hash", "")):
         raise HTTPException(status_code=400, detail="Invalid credentials")
     token = create_token({"id": str(user.get("_id")), "email": user["email"], "name": user["name"], "role": user.get("role", "customer")})
     return {"token": token, "user": {"id": str(user.get("_id")), "email": user["email"], "name": user["name"], "role": user.get("role", "customer")}}
@@ -170,69 +429,43 @@ def login(req: LoginRequest):
 
 # Products
 @app.get("/api/products")
-def list_products(q: Optional[str] = None, category: Optional[str] = None, limit: int = 20):
+async def list_products(q: Optional[str] = None, category: Optional[str] = None, limit: int = 20):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
     query: Dict[str, Any] = {}
+    projection: Dict[str, Any] = dict(PRODUCT_CARD_PROJECTION)
+    sort = None
     if q:
-        query["$or"] = [
-            {"title": {"$regex": q, "$options": "i"}},
-            {"description": {"$regex": q, "$options": "i"}},
-        ]
+        # Searches show the matched description alongside the card
+        projection["description"] = 1
+        if _product_text_index:
+            # The text index covers both title and description
+            query["$text"] = {"$search": q}
+            projection["score"] = {"$meta": "textScore"}
+            sort = {"score": {"$meta": "textScore"}}
+        else:
+            query["title"] = {"$regex": f"^{re.escape(q)}", "$options": "i"}
     if category:
         query["category"] = category
 
-    # Seed a few demo products if empty
-    if db["product"].count_documents({}) == 0:
-        samples = [
-            {
-                "title": "T-shirt Bio Confort",
-                "description": "Coton bio ultra doux, coupe moderne",
-                "price": 24.9,
-                "category": "Vêtements",
-                "images": ["https://images.unsplash.com/photo-1520975682031-a6c2b9d8b5f4?w=1200&q=80"],
-                "stock": 120,
-                "rating": 4.6,
-            },
-            {
-                "title": "Casque Sans Fil Pro",
-                "description": "Réduction de bruit active, 30h d'autonomie",
-                "price": 129.0,
-                "category": "Electronique",
-                "images": ["https://images.unsplash.com/photo-1518443206315-4e1dff4a1f0f?w=1200&q=80"],
-                "stock": 42,
-                "rating": 4.7,
-            },
-            {
-                "title": "Gourde Isotherme 1L",
-                "description": "Inox double paroi, garde au frais 24h",
-                "price": 19.9,
-                "category": "Sport",
-                "images": ["https://images.unsplash.com/photo-1563371351-e53ebb744a1f?w=1200&q=80"],
-                "stock": 300,
-                "rating": 4.5,
-            },
-        ]
-        for s in samples:
-            create_document("product", ProductSchema(**s))
-
-    docs = get_documents("product", query, limit)
-    out = []
-    for d in docs:
-        d["id"] = str(d.pop("_id", ""))
-        out.append(d)
-    return out
+    # $match stays first so the optimizer can use the text/category indexes
+    pipeline: List[Dict[str, Any]] = [{"$match": query}]
+    if sort:
+        pipeline.append({"$sort": sort})
+    # limit <= 0 means no limit, as with cursor.limit(0); $limit must be positive
+    if limit > 0:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$project": projection})
+    return await aggregate_documents("product", pipeline, limit if limit > 0 else None)
 
 
 @app.get("/api/products/{product_id}")
-def get_product(product_id: str):
-    from bson import ObjectId
+async def get_product(product_id: str):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    try:
-        doc = db["product"].find_one({"_id": ObjectId(product_id)})
-    except Exception:
+    if not ObjectId.is_valid(product_id):
         raise HTTPException(status_code=400, detail="Invalid product id")
+    doc = await db["product"].find_one({"_id": ObjectId(product_id)})
     if not doc:
         raise HTTPException(status_code=404, detail="Product not found")
     doc["id"] = str(doc.pop("_id"))
@@ -241,33 +474,36 @@ def get_product(product_id: str):
 
 # Basic admin create product (for demo). Protect by role.
 @app.post("/api/admin/products")
-def create_product(body: ProductCreate, user: AuthUser = Depends(get_current_user)):
+async def create_product(body: ProductCreate, user: AuthUser = Depends(get_current_user)):
     if user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin only")
-    product_id = create_document("product", body)
+    product_id = await create_document("product", body)
     return {"id": product_id}
 
 
 # Orders
 @app.post("/api/orders")
-def create_order(body: OrderCreate, user: Optional[AuthUser] = Depends(get_optional_user)):
+async def create_order(body: OrderCreate, user: Optional[AuthUser] = Depends(get_optional_user)):
     # attach guest user if none
     if user is None:
         body.user_id = body.user_id or "guest"
     else:
         body.user_id = user.id
+    # Friendly 400 up front; ORDER_VALIDATOR enforces the same at rest
     if len(body.items) == 0 or body.total < 0:
         raise HTTPException(status_code=400, detail="Invalid order")
-    order_id = create_document("order", body)
+    order_id = await create_document("order", body)
     return {"id": order_id, "status": "created"}
 
 
 @app.get("/api/orders/mine")
-def my_orders(user: AuthUser = Depends(get_current_user)):
-    orders = get_documents("order", {"user_id": user.id}, limit=50)
-    for o in orders:
-        o["id"] = str(o.pop("_id", ""))
-    return orders
+async def my_orders(user: AuthUser = Depends(get_current_user)):
+    pipeline = [
+        {"$match": {"user_id": user.id}},
+        {"$limit": 50},
+        {"$project": ORDER_CARD_PROJECTION},
+    ]
+    return await aggregate_documents("order", pipeline, 50)
 
 
 # Payments (Stripe or mock)
@@ -275,8 +511,8 @@ def my_orders(user: AuthUser = Depends(get_current_user)):
 def create_payment_intent(req: PaymentIntentRequest):
     if STRIPE_SECRET_KEY:
         try:
-            import stripe
-            stripe.api_key = STRIPE_SECRET_KEY
+            if stripe is None:
+                raise RuntimeError("stripe package is not installed")
             intent = stripe.PaymentIntent.create(amount=req.amount, currency=req.currency, payment_method_types=["card"]) 
             return {"clientSecret": intent.client_secret}
         except Exception as e:
@@ -285,8 +521,21 @@ def create_payment_intent(req: PaymentIntentRequest):
     return {"clientSecret": "mock_client_secret"}
 
 
+# Uptime probes hit /test every few seconds; list_collection_names is a server
+# round trip, so reuse a successful result for 30s. Failures are not cached.
+_COLLECTIONS_CACHE: TTLCache = TTLCache(maxsize=1, ttl=30)
+
+
+async def _collections() -> List[str]:
+    collections = _COLLECTIONS_CACHE.get("names")
+    if collections is None:
+        collections = await db.list_collection_names()
+        _COLLECTIONS_CACHE["names"] = collections
+    return collections
+
+
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -302,7 +551,7 @@ def test_database():
             response["database_url"] = "✅ Set" if _os.getenv("DATABASE_URL") else "❌ Not Set"
             response["database_name"] = "✅ Set" if _os.getenv("DATABASE_NAME") else "❌ Not Set"
             try:
-                collections = db.list_collection_names()
+                collections = await _collections()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
                 response["connection_status"] = "Connected"